@@ -9,7 +9,9 @@ SCOPES = ['https://www.googleapis.com/auth/drive']
 def authenticate():
     creds = None
     
-    if os.path.exists('token.pickle'):
+    if os.path.exists('token.json'):
+        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
+    elif os.path.exists('token.pickle'):
         with open('token.pickle', 'rb') as token:
             creds = pickle.load(token)
     
@@ -20,12 +22,12 @@ def authenticate():
             flow = InstalledAppFlow.from_client_secrets_file(
                 'client_secret.json', SCOPES)
             creds = flow.run_local_server(port=0)
-        
-        with open('token.pickle', 'wb') as token:
-            pickle.dump(creds, token)
+    
+    with open('token.json', 'w') as token:
+        token.write(creds.to_json())
     
     return creds
 
 if __name__ == '__main__':
     authenticate()
-    print("✅ Authentication successful! token.pickle created.")
\ No newline at end of file
+    print("✅ Authentication successful! token.json created.")
\ No newline at end of file
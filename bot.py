@@ -2,13 +2,23 @@
 # -*- coding: utf-8 -*-
 
 import os
-import json
+import functools
 import logging
+import multiprocessing
 import asyncio
-from datetime import datetime
-from typing import Dict, List, Optional
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional, Tuple
 import io
 import pickle
+import pathlib
+import random
+import re
+import stat
+import time
+
+import orjson
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
@@ -21,12 +31,14 @@ from telegram.ext import (
     filters
 )
 
+import httplib2
 from google.oauth2.credentials import Credentials
+from google_auth_httplib2 import AuthorizedHttp
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseDownload, MediaIoBaseUpload
 from googleapiclient.errors import HttpError
 
-from PIL import Image
+import img2pdf
 from PyPDF2 import PdfMerger
 import tempfile
 import threading
@@ -56,24 +68,201 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 WAITING_FOR_CODE = 1
+FOLDER_TREE_DEPTH = 4
+PARENTS_PER_QUERY = 50
+LIST_PAGE_SIZE = 1000
+DOWNLOAD_CONCURRENCY = 8
+DRIVE_HTTP_TIMEOUT = 30
+BATCH_REQUEST_LIMIT = 25
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+MENU_CHUNK_LIMIT = 4000
+SIMPLE_UPLOAD_LIMIT = 5 * 1024 * 1024
+
+TOKEN_FILE = 'token.json'
+LEGACY_TOKEN_FILE = 'token.pickle'
+RETRY_ATTEMPTS = 6
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+DRIVE_WRITE_RATE = 8
+DRIVE_WRITE_BURST = 10
+STATE_TTL = timedelta(minutes=5)
+STATE_SWEEP_INTERVAL = 60
+PDF_WORKERS = 2
+CONCURRENT_UPDATES = 256
+BLOB_CACHE_LIMIT = 1024 ** 3
+
+CONFIG = orjson.loads(pathlib.Path('config.json').read_bytes())
+
+@dataclass(frozen=True, slots=True)
+class ParsedCode:
+    ders: str
+    sinav: str
+    konu: str
+    alt_konu: Optional[str]
+    code: str
+    folder_path: Tuple[str, ...]
+
+def _build_code_index(config):
+    index = {}
+    for ders_id, ders in config['dersler'].items():
+        for sinav_id, sinav in ders['sinavlar'].items():
+            for konu_id, konu in sinav['konular'].items():
+                konu_code = f"{ders_id}.{sinav_id}.{konu_id}"
+                konu_path = (ders['ad'], sinav['ad'], konu['ad'])
+                index[konu_code] = ParsedCode(ders['ad'], sinav['ad'], konu['ad'], None, konu_code, konu_path)
+                
+                for alt_id, alt_konu in konu.get('alt_konular', {}).items():
+                    alt_code = f"{konu_code}.{alt_id}"
+                    index[alt_code] = ParsedCode(
+                        ders['ad'], sinav['ad'], konu['ad'], alt_konu, alt_code, konu_path + (alt_konu,)
+                    )
+    return index
+
+def _build_menu_chunks(config):
+    menu_parts = ["📚 **DERS VE KONU YAPISI**\n\n"]
+    
+    for ders_id, ders in config['dersler'].items():
+        menu_parts.append(f"**{ders_id}. {ders['ad']}**\n")
+        
+        for sinav_id, sinav in ders['sinavlar'].items():
+            menu_parts.append(f"  {ders_id}.{sinav_id} - {sinav['ad']}\n")
+            
+            for konu_id, konu in sinav['konular'].items():
+                menu_parts.append(f"    {ders_id}.{sinav_id}.{konu_id} - {konu['ad']}\n")
+                
+                for alt_id, alt_konu in konu.get('alt_konular', {}).items():
+                    menu_parts.append(f"      {ders_id}.{sinav_id}.{konu_id}.{alt_id} - {alt_konu}\n")
+                    
+        menu_parts.append("\n")
+        
+    menu_text = ''.join(menu_parts)
+    if len(menu_text) <= MENU_CHUNK_LIMIT:
+        return [menu_text]
+        
+    chunks = []
+    current_parts = []
+    current_len = 0
+    
+    for part in menu_text.split('\n\n'):
+        if current_len + len(part) >= MENU_CHUNK_LIMIT and current_parts:
+            chunks.append(''.join(current_parts))
+            current_parts = []
+            current_len = 0
+        current_parts.append(part + "\n\n")
+        current_len += len(part) + 2
+        
+    if current_parts:
+        chunks.append(''.join(current_parts))
+    return chunks
+
+_CODE_RE = re.compile(r'^(\d+)\.(\d+)\.(\d+)(?:\.(\d+))?(?:\.(\d+))?$')
+_FN_RE = re.compile(r'^(?P<stem>(?P<code>\d+(?:\.\d+)+)_(?P<user>.+)_(?P<ts>\d{2}-\d{2}))\.png$')
+
+CODE_INDEX: Dict[str, ParsedCode] = _build_code_index(CONFIG)
+MENU_CHUNKS = _build_menu_chunks(CONFIG)
+
+def _is_retryable(error):
+    if not isinstance(error, HttpError):
+        return False
+    if error.resp.status in RETRY_STATUSES:
+        return True
+    details = getattr(error, 'error_details', None)
+    if not isinstance(details, list):
+        details = []
+    return error.resp.status == 403 and any(
+        isinstance(detail, dict) and detail.get('reason') in RATE_LIMIT_REASONS for detail in details
+    )
+
+def _with_retry(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        delay = 1
+        for attempt in range(RETRY_ATTEMPTS):
+            try:
+                return fn(*args, **kwargs)
+            except HttpError as error:
+                if not _is_retryable(error) or attempt == RETRY_ATTEMPTS - 1:
+                    raise
+                try:
+                    wait = float(error.resp.get('retry-after', delay))
+                except ValueError:
+                    wait = delay
+                logger.warning(f"Drive returned {error.resp.status}, retrying in {wait:.0f}s")
+                time.sleep(wait + random.random())
+                delay *= 2
+    return wrapper
+
+@_with_retry
+def _execute(request):
+    return request.execute()
 
-with open('config.json', 'r', encoding='utf-8') as f:
-    CONFIG = json.load(f)
+@_with_retry
+def _next_chunk(downloader):
+    return downloader.next_chunk()
+
+@functools.lru_cache(maxsize=1)
+def _load_credentials(token_file):
+    if token_file.endswith('.json'):
+        return Credentials.from_authorized_user_file(token_file)
+    with open(token_file, 'rb') as token:
+        return pickle.load(token)
 
 class GoogleDriveManager:
-    def __init__(self, token_file='token.pickle'):
-        with open(token_file, 'rb') as token:
-            self.credentials = pickle.load(token)
-        self.service = build('drive', 'v3', credentials=self.credentials)
+    def __init__(self, token_file=TOKEN_FILE):
+        self.credentials = _load_credentials(token_file)
+        self._local = threading.local()
         self.root_folder_id = None
+        self._folder_cache: Dict[Tuple[str, str], str] = {}
+        self._count_cache: Dict[str, int] = {}
+        self._folder_lock = threading.RLock()
+        self._count_lock = threading.Lock()
+        self._blob_cache_dir = self._open_blob_cache_dir()
+        
+    def _open_blob_cache_dir(self):
+        path = pathlib.Path(tempfile.gettempdir()) / 'sorubankasi_cache'
+        path.mkdir(mode=0o700, exist_ok=True)
+        
+        path_stat = path.lstat()
+        if (
+            stat.S_ISDIR(path_stat.st_mode)
+            and path_stat.st_uid == os.getuid()
+            and not path_stat.st_mode & 0o077
+        ):
+            return path
+            
+        logger.warning(f"{path} is not a private directory, using a fresh blob cache")
+        return pathlib.Path(tempfile.mkdtemp(prefix='sorubankasi_cache_'))
+        
+    @property
+    def service(self):
+        if not hasattr(self._local, 'service'):
+            http = AuthorizedHttp(self.credentials, http=httplib2.Http(timeout=DRIVE_HTTP_TIMEOUT))
+            self._local.service = build('drive', 'v3', http=http, cache_discovery=False)
+        return self._local.service
+        
+    def _list_all(self, **params):
+        files = []
+        page_token = None
         
+        while True:
+            response = _execute(self.service.files().list(
+                pageSize=LIST_PAGE_SIZE,
+                pageToken=page_token,
+                **params
+            ))
+            files.extend(response.get('files', []))
+            
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return files
+                
     def set_root_folder(self, folder_name="SoruBankasi"):
         try:
-            response = self.service.files().list(
-                q=f"name='{folder_name}' and mimeType='application/vnd.google-apps.folder' and trashed=false",
+            response = _execute(self.service.files().list(
+                q=f"name='{folder_name}' and mimeType='{FOLDER_MIME_TYPE}' and trashed=false",
                 spaces='drive',
                 fields='files(id, name)'
-            ).execute()
+            ))
             
             if response.get('files'):
                 self.root_folder_id = response['files'][0]['id']
@@ -81,99 +270,308 @@ class GoogleDriveManager:
             else:
                 file_metadata = {
                     'name': folder_name,
-                    'mimeType': 'application/vnd.google-apps.folder'
+                    'mimeType': FOLDER_MIME_TYPE
                 }
-                folder = self.service.files().create(
+                folder = _execute(self.service.files().create(
                     body=file_metadata,
                     fields='id'
-                ).execute()
+                ))
                 self.root_folder_id = folder['id']
                 logger.info(f"Root folder created: {self.root_folder_id}")
                 
         except HttpError as error:
             logger.error(f"An error occurred: {error}")
             
-    def create_folder_structure(self, path_parts):
-        parent_id = self.root_folder_id
+    def prime_folder_tree(self):
+        parent_ids = [self.root_folder_id]
         
+        try:
+            for _ in range(FOLDER_TREE_DEPTH):
+                child_ids = []
+                
+                for i in range(0, len(parent_ids), PARENTS_PER_QUERY):
+                    chunk = set(parent_ids[i:i + PARENTS_PER_QUERY])
+                    parents_query = " or ".join(f"'{parent_id}' in parents" for parent_id in chunk)
+                    folders = self._list_all(
+                        q=f"({parents_query}) and mimeType='{FOLDER_MIME_TYPE}' and trashed=false",
+                        spaces='drive',
+                        fields='nextPageToken, files(id, name, parents)'
+                    )
+                    
+                    for folder in folders:
+                        for parent_id in folder.get('parents', []):
+                            if parent_id in chunk:
+                                self._folder_cache.setdefault((parent_id, folder['name']), folder['id'])
+                        child_ids.append(folder['id'])
+                        
+                if not child_ids:
+                    break
+                parent_ids = child_ids
+                
+            logger.info(f"Folder tree primed: {len(self._folder_cache)} folders")
+            return True
+            
+        except HttpError as error:
+            logger.error(f"Prime error: {error}")
+            return False
+            
+    def get_cached_folder(self, path_parts):
+        folder_id = self.root_folder_id
         for folder_name in path_parts:
-            response = self.service.files().list(
-                q=f"name='{folder_name}' and '{parent_id}' in parents and mimeType='application/vnd.google-apps.folder'",
-                spaces='drive',
-                fields='files(id, name)'
-            ).execute()
+            folder_id = self._folder_cache.get((folder_id, folder_name))
+            if folder_id is None:
+                return None
+        return folder_id
+        
+    def _create_folders_batched(self, keys, created):
+        retry = []
+        
+        for i in range(0, len(keys), BATCH_REQUEST_LIMIT):
+            chunk = keys[i:i + BATCH_REQUEST_LIMIT]
+            started = time.monotonic()
+            batch = self.service.new_batch_http_request()
             
-            if response.get('files'):
-                parent_id = response['files'][0]['id']
-            else:
+            for parent_id, folder_name in chunk:
+                def on_created(request_id, response, exception, key=(parent_id, folder_name)):
+                    if exception is None:
+                        self._folder_cache[key] = response['id']
+                        created.append(key)
+                    elif _is_retryable(exception):
+                        retry.append(key)
+                    else:
+                        logger.error(f"Folder create error: {exception}")
+                        
                 file_metadata = {
                     'name': folder_name,
-                    'mimeType': 'application/vnd.google-apps.folder',
+                    'mimeType': FOLDER_MIME_TYPE,
                     'parents': [parent_id]
                 }
-                folder = self.service.files().create(
-                    body=file_metadata,
-                    fields='id'
-                ).execute()
-                parent_id = folder['id']
+                batch.add(self.service.files().create(body=file_metadata, fields='id'), callback=on_created)
+                
+            _execute(batch)
+            time.sleep(max(0, len(chunk) / DRIVE_WRITE_RATE - (time.monotonic() - started)))
+            
+        return retry
+        
+    def create_missing_folders(self, paths):
+        created = []
+        
+        for depth in range(1, FOLDER_TREE_DEPTH + 1):
+            missing = []
+            for path in paths:
+                if len(path) < depth:
+                    continue
+                parent_id = self.get_cached_folder(path[:depth - 1])
+                key = (parent_id, path[depth - 1])
+                if parent_id is not None and key not in self._folder_cache and key not in missing:
+                    missing.append(key)
+                    
+            delay = 1
+            for attempt in range(RETRY_ATTEMPTS):
+                try:
+                    missing = self._create_folders_batched(missing, created)
+                except HttpError as error:
+                    logger.error(f"Batch create error: {error}")
+                    return len(created)
+                    
+                if not missing or attempt == RETRY_ATTEMPTS - 1:
+                    break
+                logger.warning(f"Retrying {len(missing)} folder creates in {delay}s")
+                time.sleep(delay + random.random())
+                delay *= 2
+                
+            if missing:
+                logger.error(f"Folder create gave up on: {[name for _, name in missing]}")
+                
+        if created:
+            logger.info(f"Missing folders created: {len(created)}")
+        return len(created)
+        
+    def create_folder_structure(self, path_parts):
+        parent_id = self.root_folder_id
+        
+        for folder_name in path_parts:
+            key = (parent_id, folder_name)
+            folder_id = self._folder_cache.get(key)
+            
+            if folder_id is None:
+                with self._folder_lock:
+                    folder_id = self._folder_cache.get(key)
+                    if folder_id is None:
+                        try:
+                            response = _execute(self.service.files().list(
+                                q=f"name='{folder_name}' and '{parent_id}' in parents and mimeType='{FOLDER_MIME_TYPE}'",
+                                spaces='drive',
+                                fields='files(id, name)'
+                            ))
+                    
+                            if response.get('files'):
+                                folder_id = response['files'][0]['id']
+                            else:
+                                file_metadata = {
+                                    'name': folder_name,
+                                    'mimeType': FOLDER_MIME_TYPE,
+                                    'parents': [parent_id]
+                                }
+                                folder = _execute(self.service.files().create(
+                                    body=file_metadata,
+                                    fields='id'
+                                ))
+                                folder_id = folder['id']
+                        
+                        except HttpError:
+                            self.invalidate_folder(parent_id)
+                            raise
+                    
+                        self._folder_cache[key] = folder_id
+            parent_id = folder_id
                 
         return parent_id
         
-    def upload_image(self, image_bytes, filename, folder_id):
+    def invalidate_folder(self, folder_id):
+        with self._folder_lock:
+            stale = [key for key, cached_id in self._folder_cache.items() if cached_id == folder_id]
+            for key in stale:
+                del self._folder_cache[key]
+            
+    def upload_image(self, image_stream, filename, folder_id):
         try:
             file_metadata = {
                 'name': filename,
                 'parents': [folder_id]
             }
             
+            image_stream.seek(0, io.SEEK_END)
+            resumable = image_stream.tell() >= SIMPLE_UPLOAD_LIMIT
+            image_stream.seek(0)
+            
             media = MediaIoBaseUpload(
-                io.BytesIO(image_bytes),
+                image_stream,
                 mimetype='image/png',
-                resumable=True
+                chunksize=-1,
+                resumable=resumable
             )
             
-            file = self.service.files().create(
+            file = _execute(self.service.files().create(
                 body=file_metadata,
                 media_body=media,
                 fields='id, name, webViewLink'
-            ).execute()
+            ))
             
             return file
             
         except HttpError as error:
             logger.error(f"Upload error: {error}")
+            self.invalidate_folder(folder_id)
             return None
             
     def count_files_in_folder(self, folder_id):
         try:
-            response = self.service.files().list(
+            files = self._list_all(
                 q=f"'{folder_id}' in parents and mimeType='image/png'",
                 spaces='drive',
-                fields='files(id, name)'
-            ).execute()
+                fields='nextPageToken, files(id)'
+            )
             
-            return len(response.get('files', []))
+            return len(files)
             
         except HttpError as error:
             logger.error(f"Count error: {error}")
-            return 0
+            self.invalidate_folder(folder_id)
+            return None
+            
+    def reserve_file_number(self, folder_id):
+        seed = None
+        
+        while True:
+            with self._count_lock:
+                if folder_id in self._count_cache:
+                    self._count_cache[folder_id] += 1
+                    return self._count_cache[folder_id]
+                if seed is not None:
+                    self._count_cache[folder_id] = seed + 1
+                    return seed + 1
+                    
+            seed = self.count_files_in_folder(folder_id)
+            if seed is None:
+                return 1
             
     def list_files_in_folder(self, folder_id):
         try:
-            response = self.service.files().list(
-                q=f"'{folder_id}' in parents and mimeType='image/png'",
+            return self._list_all(
+                q=f"'{folder_id}' in parents and mimeType='image/png' and trashed=false",
                 spaces='drive',
                 orderBy='name',
-                fields='files(id, name, createdTime, webViewLink)'
-            ).execute()
-            
-            return response.get('files', [])
+                fields='nextPageToken, files(id, name, createdTime, modifiedTime, webViewLink)'
+            )
             
         except HttpError as error:
             logger.error(f"List error: {error}")
+            self.invalidate_folder(folder_id)
             return []
             
-    def download_file(self, file_id):
+    def find_files_by_code(self, code):
+        prefix = f"{code}."
+        
+        try:
+            files = self._list_all(
+                q=f"name contains '{prefix}' and mimeType='image/png' and trashed=false",
+                spaces='drive',
+                orderBy='name',
+                fields='nextPageToken, files(id, name, createdTime, modifiedTime, webViewLink)'
+            )
+            
+        except HttpError as error:
+            logger.error(f"Search error: {error}")
+            return []
+            
+        return [
+            file for file in files
+            if (match := _FN_RE.match(file['name'])) and match['code'].rpartition('.')[0] == code
+        ]
+        
+    def list_files_in_folders(self, folder_ids):
+        if len(folder_ids) == 1:
+            return {folder_ids[0]: self.list_files_in_folder(folder_ids[0])}
+            
+        results = {folder_id: [] for folder_id in folder_ids}
+        
+        for i in range(0, len(folder_ids), PARENTS_PER_QUERY):
+            chunk = folder_ids[i:i + PARENTS_PER_QUERY]
+            parents_query = " or ".join(f"'{folder_id}' in parents" for folder_id in chunk)
+            
+            try:
+                files = self._list_all(
+                    q=f"({parents_query}) and mimeType='image/png' and trashed=false",
+                    spaces='drive',
+                    orderBy='name',
+                    fields='nextPageToken, files(id, name, parents, createdTime, modifiedTime, webViewLink)'
+                )
+                
+            except HttpError as error:
+                logger.error(f"List error: {error}")
+                for folder_id in chunk:
+                    self.invalidate_folder(folder_id)
+                continue
+                
+            for file in files:
+                for parent_id in file.get('parents', []):
+                    if parent_id in results:
+                        results[parent_id].append(file)
+                        
+        return results
+        
+    def download_file(self, file_id, modified_time=None):
+        cache_path = None
+        if modified_time:
+            cache_path = self._blob_cache_dir / f"{file_id}_{modified_time.replace(':', '-')}.png"
+            try:
+                data = cache_path.read_bytes()
+                os.utime(cache_path)
+                return data
+            except FileNotFoundError:
+                pass
+                
         try:
             request = self.service.files().get_media(fileId=file_id)
             file_bytes = io.BytesIO()
@@ -181,67 +579,98 @@ class GoogleDriveManager:
             
             done = False
             while not done:
-                status, done = downloader.next_chunk()
+                status, done = _next_chunk(downloader)
                 
-            file_bytes.seek(0)
-            return file_bytes.read()
+            data = file_bytes.getvalue()
             
         except HttpError as error:
             logger.error(f"Download error: {error}")
             return None
+            
+        if cache_path:
+            tmp_path = cache_path.with_name(f"{cache_path.name}.{threading.get_ident()}.tmp")
+            try:
+                tmp_path.write_bytes(data)
+                os.replace(tmp_path, cache_path)
+            except OSError as error:
+                logger.warning(f"Blob cache write error: {error}")
+                try:
+                    os.unlink(tmp_path)
+                except OSError:
+                    pass
+                
+        return data
+        
+    def trim_blob_cache(self):
+        entries = []
+        total_size = 0
+        
+        with os.scandir(self._blob_cache_dir) as it:
+            for entry in it:
+                try:
+                    if not entry.is_file() or not entry.name.endswith('.png'):
+                        continue
+                    entry_stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((entry_stat.st_atime, entry_stat.st_size, entry.path))
+                total_size += entry_stat.st_size
+                    
+        for _, size, path in sorted(entries):
+            if total_size <= BLOB_CACHE_LIMIT:
+                break
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            total_size -= size
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+        
+    async def take(self):
+        async with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                self.tokens = 0
+                self.updated = time.monotonic()
+            else:
+                self.tokens -= 1
 
 class SoruBankasiBot:
-    def __init__(self, token, token_pickle_file='token.pickle'):
+    def __init__(self, token, token_file=TOKEN_FILE):
         self.token = token
-        self.drive = GoogleDriveManager(token_pickle_file)
+        self.write_bucket = TokenBucket(DRIVE_WRITE_RATE, DRIVE_WRITE_BURST)
+        self._pdf_pool = ProcessPoolExecutor(
+            max_workers=PDF_WORKERS,
+            mp_context=multiprocessing.get_context('forkserver')
+        )
+        self.drive = GoogleDriveManager(token_file)
         self.drive.set_root_folder()
+        if self.drive.root_folder_id and self.drive.prime_folder_tree():
+            self.drive.create_missing_folders([parsed.folder_path for parsed in CODE_INDEX.values()])
         self.user_states = {}
         
     def parse_code(self, code):
-        try:
-            parts = code.split('.')
-            if len(parts) < 3:
-                return None
-                
-            ders_id = parts[0]
-            sinav_id = parts[1]
-            konu_id = parts[2]
-            alt_konu_id = parts[3] if len(parts) > 3 else None
-            
-            if ders_id not in CONFIG['dersler']:
-                return None
-                
-            ders = CONFIG['dersler'][ders_id]
-            
-            if sinav_id not in ders['sinavlar']:
-                return None
-                
-            sinav = ders['sinavlar'][sinav_id]
-            
-            if konu_id not in sinav['konular']:
-                return None
-                
-            konu = sinav['konular'][konu_id]
-            
-            result = {
-                'ders': ders['ad'],
-                'sinav': sinav['ad'],
-                'konu': konu['ad'],
-                'alt_konu': None,
-                'code': code,
-                'folder_path': [ders['ad'], sinav['ad'], konu['ad']]
-            }
-            
-            if alt_konu_id and alt_konu_id in konu.get('alt_konular', {}):
-                result['alt_konu'] = konu['alt_konular'][alt_konu_id]
-                result['folder_path'].append(result['alt_konu'])
-                
-            return result
-            
-        except Exception as e:
-            logger.error(f"Parse error: {e}")
+        match = _CODE_RE.match(code.strip())
+        if not match:
             return None
             
+        ders_id, sinav_id, konu_id, alt_konu_id, _ = match.groups()
+        konu_code = f"{ders_id}.{sinav_id}.{konu_id}"
+        if alt_konu_id and f"{konu_code}.{alt_konu_id}" in CODE_INDEX:
+            return CODE_INDEX[f"{konu_code}.{alt_konu_id}"]
+        return CODE_INDEX.get(konu_code)
+            
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
         welcome_text = f"""
@@ -267,37 +696,8 @@ Ders.Sınav.Konu.AltKonu
         await update.message.reply_text(welcome_text, parse_mode='Markdown')
         
     async def menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        menu_text = "📚 **DERS VE KONU YAPISI**\n\n"
-        
-        for ders_id, ders in CONFIG['dersler'].items():
-            menu_text += f"**{ders_id}. {ders['ad']}**\n"
-            
-            for sinav_id, sinav in ders['sinavlar'].items():
-                menu_text += f"  {ders_id}.{sinav_id} - {sinav['ad']}\n"
-                
-                for konu_id, konu in sinav['konular'].items():
-                    menu_text += f"    {ders_id}.{sinav_id}.{konu_id} - {konu['ad']}\n"
-                    
-                    for alt_id, alt_konu in konu.get('alt_konular', {}).items():
-                        menu_text += f"      {ders_id}.{sinav_id}.{konu_id}.{alt_id} - {alt_konu}\n"
-                        
-            menu_text += "\n"
-            
-        if len(menu_text) > 4000:
-            parts = menu_text.split('\n\n')
-            current_msg = ""
-            
-            for part in parts:
-                if len(current_msg) + len(part) < 4000:
-                    current_msg += part + "\n\n"
-                else:
-                    await update.message.reply_text(current_msg, parse_mode='Markdown')
-                    current_msg = part + "\n\n"
-                    
-            if current_msg:
-                await update.message.reply_text(current_msg, parse_mode='Markdown')
-        else:
-            await update.message.reply_text(menu_text, parse_mode='Markdown')
+        for chunk in MENU_CHUNKS:
+            await update.message.reply_text(chunk, parse_mode='Markdown')
             
     async def handle_photo(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user = update.effective_user
@@ -305,15 +705,22 @@ Ders.Sınav.Konu.AltKonu
         
         photo_file = await update.message.photo[-1].get_file()
         
-        photo_bytes = io.BytesIO()
-        await photo_file.download_to_memory(photo_bytes)
-        photo_bytes.seek(0)
-        
+        with tempfile.NamedTemporaryFile(suffix='.png', delete=False) as photo_tmp:
+            try:
+                await photo_file.download_to_memory(photo_tmp)
+            except Exception:
+                photo_tmp.close()
+                self._remove_photo(photo_tmp.name)
+                raise
+                
+        previous = self.user_states.get(user_id)
         self.user_states[user_id] = {
-            'photo': photo_bytes.read(),
+            'path': photo_tmp.name,
             'username': user.username or user.first_name,
             'timestamp': datetime.now()
         }
+        if previous:
+            self._remove_photo(previous['path'])
         
         await update.message.reply_text(
             "📸 Fotoğraf alındı!\n\n"
@@ -342,27 +749,36 @@ Ders.Sınav.Konu.AltKonu
             )
             return WAITING_FOR_CODE
             
-        folder_id = self.drive.create_folder_structure(parsed['folder_path'])
-        
-        file_count = self.drive.count_files_in_folder(folder_id)
-        new_number = file_count + 1
-        
-        timestamp = datetime.now().strftime("%H-%M")
-        username = self.user_states[user_id]['username']
-        filename = f"{code}.{new_number}_{username}_{timestamp}.png"
-        
-        photo_bytes = self.user_states[user_id]['photo']
-        uploaded_file = self.drive.upload_image(photo_bytes, filename, folder_id)
+        state = self.user_states.pop(user_id, None)
+        if state is None:
+            return ConversationHandler.END
+            
+        try:
+            if self.drive.get_cached_folder(parsed.folder_path) is None:
+                await self.write_bucket.take()
+            folder_id = await asyncio.to_thread(self.drive.create_folder_structure, parsed.folder_path)
+            
+            new_number = await asyncio.to_thread(self.drive.reserve_file_number, folder_id)
+            
+            timestamp = datetime.now().strftime("%H-%M")
+            username = state['username']
+            filename = f"{parsed.code}.{new_number}_{username}_{timestamp}.png"
+            
+            await self.write_bucket.take()
+            with open(state['path'], 'rb') as photo_stream:
+                uploaded_file = await asyncio.to_thread(self.drive.upload_image, photo_stream, filename, folder_id)
+        finally:
+            self._remove_photo(state['path'])
         
         if uploaded_file:
             response_text = f"""
 ✅ **Başarıyla kaydedildi!**
 
 📚 **Konum:**
-{parsed['ders']} > {parsed['sinav']} > {parsed['konu']}"""
+{parsed.ders} > {parsed.sinav} > {parsed.konu}"""
 
-            if parsed['alt_konu']:
-                response_text += f" > {parsed['alt_konu']}"
+            if parsed.alt_konu:
+                response_text += f" > {parsed.alt_konu}"
                 
             response_text += f"""
 
@@ -375,7 +791,6 @@ Ders.Sınav.Konu.AltKonu
         else:
             await update.message.reply_text("❌ Yükleme hatası! Lütfen tekrar deneyin.")
             
-        del self.user_states[user_id]
         return ConversationHandler.END
         
     async def list_questions(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -393,23 +808,25 @@ Ders.Sınav.Konu.AltKonu
             await update.message.reply_text("❌ Geçersiz kod!")
             return
             
-        folder_id = self.drive.create_folder_structure(parsed['folder_path'])
-        files = self.drive.list_files_in_folder(folder_id)
+        folder_id = self.drive.get_cached_folder(parsed.folder_path)
+        if folder_id:
+            files = await asyncio.to_thread(self.drive.list_files_in_folder, folder_id)
+        else:
+            files = await asyncio.to_thread(self.drive.find_files_by_code, parsed.code)
         
         if not files:
             await update.message.reply_text("📭 Bu konuda henüz soru yok!")
             return
             
-        response = f"📚 **{parsed['konu']}**"
-        if parsed['alt_konu']:
-            response += f" > {parsed['alt_konu']}"
+        response = f"📚 **{parsed.konu}**"
+        if parsed.alt_konu:
+            response += f" > {parsed.alt_konu}"
         response += f"\n\n📄 **{len(files)} soru:**\n\n"
         
         for i, file in enumerate(files, 1):
-            name_parts = file['name'].split('_')
-            if len(name_parts) >= 2:
-                user = name_parts[-2]
-                response += f"{i}. {file['name'].split('.png')[0]} - {user}\n"
+            match = _FN_RE.match(file['name'])
+            if match:
+                response += f"{i}. {match['stem']} - {match['user']}\n"
             else:
                 response += f"{i}. {file['name']}\n"
                 
@@ -425,56 +842,61 @@ Ders.Sınav.Konu.AltKonu
             
         await update.message.reply_text("📄 PDF oluşturuluyor...")
         
-        images = []
+        targets = []
         
         for code in context.args:
-            parts = code.rsplit('.', 1)
-            if len(parts) == 2:
-                base_code = parts[0]
-                question_num = parts[1]
-            else:
-                base_code = code
-                question_num = None
+            match = _CODE_RE.match(code)
+            if not match:
+                continue
                 
-            parsed = self.parse_code(base_code)
+            parts = [part for part in match.groups() if part]
+            parsed = self.parse_code('.'.join(parts[:-1]))
             if not parsed:
                 continue
                 
-            folder_id = self.drive.create_folder_structure(parsed['folder_path'])
-            files = self.drive.list_files_in_folder(folder_id)
+            if self.drive.get_cached_folder(parsed.folder_path) is None:
+                await self.write_bucket.take()
+            folder_id = await asyncio.to_thread(self.drive.create_folder_structure, parsed.folder_path)
+            targets.append((folder_id, code))
             
-            for file in files:
-                if question_num:
-                    if f"{base_code}.{question_num}_" in file['name']:
-                        file_bytes = self.drive.download_file(file['id'])
-                        if file_bytes:
-                            images.append(Image.open(io.BytesIO(file_bytes)))
-                else:
-                    file_bytes = self.drive.download_file(file['id'])
-                    if file_bytes:
-                        images.append(Image.open(io.BytesIO(file_bytes)))
-                        
-        if not images:
+        folder_ids = list(dict.fromkeys(folder_id for folder_id, _ in targets))
+        files_by_folder = await asyncio.to_thread(self.drive.list_files_in_folders, folder_ids)
+        
+        wanted = []
+        for folder_id, code in targets:
+            for file in files_by_folder[folder_id]:
+                match = _FN_RE.match(file['name'])
+                if match and match['code'] == code:
+                    wanted.append(file)
+                    
+        semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+        
+        async def download(file):
+            async with semaphore:
+                return await asyncio.to_thread(self.drive.download_file, file['id'], file.get('modifiedTime'))
+                
+        blobs = await asyncio.gather(*[download(file) for file in wanted])
+        await asyncio.to_thread(self.drive.trim_blob_cache)
+        png_blobs = [blob for blob in blobs if blob]
+        
+        if not png_blobs:
             await update.message.reply_text("❌ Görüntü bulunamadı!")
             return
             
-        pdf_bytes = io.BytesIO()
-        
-        if images:
-            images[0].save(
-                pdf_bytes,
-                "PDF",
-                save_all=True,
-                append_images=images[1:] if len(images) > 1 else []
-            )
+        try:
+            pdf_data = await asyncio.get_running_loop().run_in_executor(self._pdf_pool, img2pdf.convert, png_blobs)
+        except Exception as e:
+            logger.error(f"PDF error: {e}")
+            await update.message.reply_text("❌ PDF oluşturulamadı! Lütfen tekrar deneyin.")
+            return
             
-        pdf_bytes.seek(0)
+        pdf_bytes = io.BytesIO(pdf_data)
         
         filename = f"sorular_{datetime.now().strftime('%Y%m%d_%H%M')}.pdf"
         await update.message.reply_document(
             document=pdf_bytes,
             filename=filename,
-            caption=f"📄 {len(images)} soru içeren PDF oluşturuldu!"
+            caption=f"📄 {len(png_blobs)} soru içeren PDF oluşturuldu!"
         )
         
     async def help_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -509,13 +931,50 @@ Ders.Sınav.Konu.AltKonu
         
     async def cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_id = update.effective_user.id
-        if user_id in self.user_states:
-            del self.user_states[user_id]
+        self._discard_state(user_id)
         await update.message.reply_text("İşlem iptal edildi.")
         return ConversationHandler.END
         
+    def _remove_photo(self, path):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+            
+    def _discard_state(self, user_id):
+        state = self.user_states.pop(user_id, None)
+        if state:
+            self._remove_photo(state['path'])
+            
+    async def _sweep_user_states(self):
+        while True:
+            await asyncio.sleep(STATE_SWEEP_INTERVAL)
+            cutoff = datetime.now() - STATE_TTL
+            expired = [user_id for user_id, state in self.user_states.items() if state['timestamp'] < cutoff]
+            for user_id in expired:
+                self._discard_state(user_id)
+            if expired:
+                logger.info(f"Expired pending photos: {len(expired)}")
+                
+    async def _post_init(self, application):
+        self._sweeper_task = asyncio.create_task(self._sweep_user_states())
+        
+    async def _post_shutdown(self, application):
+        self._sweeper_task.cancel()
+        self._pdf_pool.shutdown(wait=False, cancel_futures=True)
+        for user_id in list(self.user_states):
+            self._discard_state(user_id)
+            
     def run(self):
-        application = Application.builder().token(self.token).build()
+        application = (
+            Application.builder()
+            .token(self.token)
+            .concurrent_updates(CONCURRENT_UPDATES)
+            .http_version("2")
+            .post_init(self._post_init)
+            .post_shutdown(self._post_shutdown)
+            .build()
+        )
         
         conv_handler = ConversationHandler(
             entry_points=[MessageHandler(filters.PHOTO, self.handle_photo)],
@@ -547,17 +1006,22 @@ if __name__ == '__main__':
         exit(1)
     
     if os.getenv('GOOGLE_CREDENTIALS'):
-        google_creds_b64 = os.getenv('GOOGLE_CREDENTIALS')
-        with open('token.pickle', 'wb') as f:
-            f.write(base64.b64decode(google_creds_b64))
+        google_creds = base64.b64decode(os.getenv('GOOGLE_CREDENTIALS'))
+        creds_file = TOKEN_FILE if google_creds.lstrip().startswith(b'{') else LEGACY_TOKEN_FILE
+        with open(creds_file, 'wb') as f:
+            f.write(google_creds)
         print("✅ Google credentials loaded from environment")
     
-    if not os.path.exists('token.pickle'):
-        print("❌ token.pickle bulunamadı!")
+    if os.path.exists(TOKEN_FILE):
+        token_file = TOKEN_FILE
+    elif os.path.exists(LEGACY_TOKEN_FILE):
+        token_file = LEGACY_TOKEN_FILE
+    else:
+        print(f"❌ {TOKEN_FILE} bulunamadı!")
         print("Önce 'python auth.py' çalıştırın")
         exit(1)
         
-    bot = SoruBankasiBot(TELEGRAM_TOKEN)
+    bot = SoruBankasiBot(TELEGRAM_TOKEN, token_file)
     print("✅ Bot başlatılıyor...")
     print("Durdurmak için Ctrl+C")
     run_health_server()